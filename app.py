@@ -1,13 +1,23 @@
+import asyncio
 import os
 import shutil
-import uuid
+import tempfile
+from tempfile import SpooledTemporaryFile
 from typing import Literal
 
+import anyio
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
-from ocr_engine import light_extract_text, premium_extract_text, optimum_extract_text
+from ocr_engine import (
+    OCR_WORKERS,
+    extract_text,
+    file_digest,
+    shutdown_tesseract,
+    warmup_tesseract,
+)
 from parsers.tsh import premium_parse_tsh
 
 
@@ -42,18 +52,87 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def load_ocr_engine():
+    """Charge le pool Tesseract persistant avant la première requête."""
+    warmup_tesseract()
+
+
+@app.on_event("shutdown")
+def release_ocr_engine():
+    shutdown_tesseract()
+
+
 # =========================================================
 # UTILS
 # =========================================================
 
+# Taille de bloc pour la copie et le buffer d'écriture du fichier temporaire
+# (défauts : 64 Ko pour shutil, 8 Ko pour open)
+COPY_BUFSIZE = 1024 * 1024
+
+# Content-Types acceptés en plus de image/* : PDF et type générique. Le
+# vrai format est reconnu ensuite sur le contenu (Pillow / _is_pdf)
+_GENERIC_CT = frozenset({"application/pdf", "application/octet-stream"})
+
+
+def _is_supported_content_type(ct: str | None) -> bool:
+    """Content-Type accepté ? Absent, image/*, PDF ou octet-stream (Bubble,
+    clients HTTP génériques). Les paramètres (`; charset=...`) sont ignorés."""
+    if not ct:
+        return True
+    ct = ct.split(";", 1)[0].strip().lower()
+    return ct.startswith("image/") or ct in _GENERIC_CT
+
+
+def _copy_file(src, dst) -> None:
+    """Copie fichier -> fichier, via os.sendfile (copie dans le noyau)
+    quand c'est possible, sinon par blocs de COPY_BUFSIZE."""
+    offset = 0
+    if hasattr(os, "sendfile"):
+        try:
+            in_fd = src.fileno()
+            out_fd = dst.fileno()
+            size = os.fstat(in_fd).st_size
+            while offset < size:
+                sent = os.sendfile(out_fd, in_fd, offset, size - offset)
+                if not sent:
+                    break
+                offset += sent
+        except (OSError, ValueError):
+            # pas de descripteur (BytesIO : io.UnsupportedOperation, offset
+            # resté à 0) ou sendfile refusé en route (fs exotique...) : on
+            # finit en espace utilisateur après ce qui est déjà copié
+            pass
+        else:
+            if offset >= size:
+                return
+
+    src.seek(offset)
+    shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+
+
 def save_temp_file(upload: UploadFile) -> str:
-    """Save file to /tmp with a random name."""
-    ext = os.path.splitext(upload.filename)[1].lower()
-    fname = f"tmp_{uuid.uuid4().hex}{ext}"
-    path = os.path.join("/tmp", fname)
+    """Save file to /tmp with a random name.
 
-    with open(path, "wb") as f:
-        shutil.copyfileobj(upload.file, f)
+    Starlette a déjà spoolé le corps de la requête (en mémoire si petit,
+    sur disque sinon) : on évite de le recopier par petits blocs.
+    """
+    ext = os.path.splitext(upload.filename or "")[1].lower()
+    # mkstemp : nom aléatoire + création exclusive en un seul appel
+    fd, path = tempfile.mkstemp(prefix="tmp_", suffix=ext, dir="/tmp")
+
+    spool = upload.file
+    spool.seek(0)
+
+    with os.fdopen(fd, "wb", buffering=COPY_BUFSIZE) as f:
+        if isinstance(spool, SpooledTemporaryFile) and not spool._rolled:
+            # Upload encore en mémoire : une seule écriture du buffer
+            with spool._file.getbuffer() as buf:
+                f.write(buf)
+        else:
+            # Upload déjà spoolé sur disque par Starlette
+            _copy_file(spool, f)
 
     return path
 
@@ -71,23 +150,23 @@ async def health():
 # INTERNAL HELPER
 # =========================================================
 
-def _run_and_parse(path: str, level: Literal["light", "premium", "optimum"]):
+def _run_and_parse(
+    path: str,
+    level: Literal["light", "premium", "optimum"],
+    digest: str | None = None,
+):
     """Run OCR at the given level and parse TSH.
 
+    `digest` (empreinte du fichier) sert de clé au cache OCR ; calculée
+    une seule fois par requête, même en mode auto.
+
     Returns:
         (parsed, error, raw_text)
         - parsed: result object from premium_parse_tsh or None
         - error: error string or None
         - raw_text: raw OCR text or None
     """
-    if level == "light":
-        extract = light_extract_text
-    elif level == "premium":
-        extract = premium_extract_text
-    else:
-        extract = optimum_extract_text
-
-    ocr = extract(path)
+    ocr = extract_text(path, level, digest)
     if not ocr:
         return None, "OCR_FAILED", None
 
@@ -98,6 +177,68 @@ def _run_and_parse(path: str, level: Literal["light", "premium", "optimum"]):
     return parsed, None, ocr.raw_text
 
 
+# Taille max du texte OCR renvoyé dans la réponse (un bilan de 50 pages
+# peut produire des centaines de Ko que personne ne lit côté client)
+RAW_TEXT_MAX_CHARS = 8192
+
+
+def _response_raw_text(raw_text: str | None, include: bool) -> str | None:
+    """raw_text tel que renvoyé au client : omis ou tronqué."""
+    if not include or raw_text is None:
+        return None
+    return raw_text[:RAW_TEXT_MAX_CHARS]
+
+
+# Ordre de préférence des niveaux en mode auto. premium n'y figure pas :
+# même pré-traitement et même passe Tesseract que light, et le parseur
+# n'exploite pas les boxes -> ce serait une 2e inférence pour le même texte
+AUTO_LEVELS = ("light", "optimum")
+
+# Avance (s) donnée à light en mode auto : optimum, la passe la plus
+# coûteuse, n'est lancé que si light n'a pas abouti avec des bornes d'ici là
+AUTO_HEAD_START = 2.0
+
+# Nombre max de passes OCR simultanées, toutes requêtes confondues : une
+# par instance du pool Tesseract (sémaphore anyio : pas lié à une boucle
+# d'événements précise)
+OCR_SEMAPHORE = anyio.Semaphore(OCR_WORKERS)
+
+
+def _release_ocr_slot(job: "asyncio.Future") -> None:
+    """Fin réelle d'une passe OCR : libère sa place dans OCR_SEMAPHORE."""
+    OCR_SEMAPHORE.release()
+    if not job.cancelled():
+        # résultat déjà consommé ou abandonné : pas d'avertissement asyncio
+        job.exception()
+
+
+async def _run_level(
+    path: str,
+    level: Literal["light", "premium", "optimum"],
+    digest: str | None = None,
+):
+    """_run_and_parse dans le threadpool, borné par OCR_SEMAPHORE.
+
+    Annuler l'appelant ne stoppe pas le thread déjà lancé : la place dans
+    le sémaphore n'est rendue qu'à la fin effective de la passe OCR.
+    """
+    await OCR_SEMAPHORE.acquire()
+    try:
+        job = asyncio.ensure_future(
+            run_in_threadpool(_run_and_parse, path, level, digest)
+        )
+    except BaseException:
+        OCR_SEMAPHORE.release()
+        raise
+    job.add_done_callback(_release_ocr_slot)
+    return await asyncio.shield(job)
+
+
+def _has_bounds(parsed) -> bool:
+    """Résultat parsé avec au moins une borne de référence ?"""
+    return bool(parsed) and not (parsed.ref_min is None and parsed.ref_max is None)
+
+
 # =========================================================
 # OCR TSH ENDPOINT (MULTI-LEVEL)
 # =========================================================
@@ -106,6 +247,7 @@ def _run_and_parse(path: str, level: Literal["light", "premium", "optimum"]):
 async def ocr_tsh(
     file: UploadFile = File(...),
     mode: Literal["auto", "light", "premium", "optimum"] = "auto",
+    include_raw_text: bool = True,
 ):
     """Full OCR pipeline for TSH.
 
@@ -119,22 +261,31 @@ async def ocr_tsh(
       - light:    1 seul passage OCR rapide
       - premium:  qualité standard (texte + boxes)
       - optimum:  mode renforcé pour images difficiles
-      - auto:     light -> premium -> optimum (fallback progressif)
+      - auto:     light d'abord ; si pas de bornes après AUTO_HEAD_START,
+                  optimum en parallèle ; on garde le premier résultat
+                  avec bornes, sinon celui d'optimum
+
+    raw_text est tronqué à RAW_TEXT_MAX_CHARS ; include_raw_text=false
+    l'omet complètement (réponse plus légère pour Bubble).
     """
     if not file:
         raise HTTPException(status_code=400, detail="Missing file")
 
-    # 1. Save file
-    tmp_path = save_temp_file(file)
+    if not _is_supported_content_type(file.content_type):
+        raise HTTPException(status_code=415, detail="Unsupported file type")
+
+    # 1. Save file (hors de la boucle d'événements : I/O disque bloquante)
+    tmp_path = await run_in_threadpool(save_temp_file, file)
+    digest = await run_in_threadpool(file_digest, tmp_path)
 
     # Explicit modes: single pass
     if mode in ("light", "premium", "optimum"):
-        parsed, error, raw_text = _run_and_parse(tmp_path, mode)
+        parsed, error, raw_text = await _run_level(tmp_path, mode, digest)
         if not parsed:
             return TSHResponse(
                 ok=False,
                 error=error,
-                raw_text=raw_text,
+                raw_text=_response_raw_text(raw_text, include_raw_text),
             )
 
         return TSHResponse(
@@ -144,39 +295,58 @@ async def ocr_tsh(
             ref_min=parsed.ref_min,
             ref_max=parsed.ref_max,
             confidence=parsed.confidence,
-            raw_text=raw_text,
+            raw_text=_response_raw_text(raw_text, include_raw_text),
         )
 
-      # MODE AUTO : light -> premium -> optimum
+    # MODE AUTO : light d'abord ; optimum en parallèle seulement si light
+    # n'a pas abouti avec des bornes après AUTO_HEAD_START secondes
     if mode == "auto":
-        # 1) Light
-        parsed, error, raw_text = _run_and_parse(tmp_path, "light")
-        if parsed and not (parsed.ref_min is None and parsed.ref_max is None):
-            return TSHResponse(
-                ok=True,
-                tsh_value=parsed.value,
-                tsh_unit=parsed.unit,
-                ref_min=parsed.ref_min,
-                ref_max=parsed.ref_max,
-                confidence=parsed.confidence,
-                raw_text=raw_text,
-            )
-
-        # 2) Premium
-        parsed, error, raw_text = _run_and_parse(tmp_path, "premium")
-        if parsed and not (parsed.ref_min is None and parsed.ref_max is None):
-            return TSHResponse(
-                ok=True,
-                tsh_value=parsed.value,
-                tsh_unit=parsed.unit,
-                ref_min=parsed.ref_min,
-                ref_max=parsed.ref_max,
-                confidence=parsed.confidence,
-                raw_text=raw_text,
-            )
-
-        # 3) Optimum – dernier recours, on accepte même sans bornes
-        parsed, error, raw_text = _run_and_parse(tmp_path, "optimum")
+        first, fallback = AUTO_LEVELS
+        first_task = asyncio.create_task(_run_level(tmp_path, first, digest))
+        tasks = {first_task: first}
+        results = {}
+        pending = {first_task}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=AUTO_HEAD_START)
+            if done:
+                results[first] = first_task.result()
+            if not (first in results and _has_bounds(results[first][0])):
+                task = asyncio.create_task(_run_level(tmp_path, fallback, digest))
+                tasks[task] = fallback
+                pending.add(task)
+
+            while True:
+                # Premier niveau terminé avec des bornes -> on répond
+                for level in AUTO_LEVELS:
+                    if level not in results:
+                        continue
+                    parsed, error, raw_text = results[level]
+                    if _has_bounds(parsed):
+                        return TSHResponse(
+                            ok=True,
+                            tsh_value=parsed.value,
+                            tsh_unit=parsed.unit,
+                            ref_min=parsed.ref_min,
+                            ref_max=parsed.ref_max,
+                            confidence=parsed.confidence,
+                            raw_text=_response_raw_text(raw_text, include_raw_text),
+                        )
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    results[tasks[task]] = task.result()
+        finally:
+            # Les passes encore en cours ne servent plus (leur résultat
+            # OCR reste en cache pour un éventuel renvoi du même fichier) ;
+            # elles gardent leur place dans OCR_SEMAPHORE jusqu'au bout
+            for task in pending:
+                task.cancel()
+
+        # Optimum – dernier recours, on accepte même sans bornes
+        parsed, error, raw_text = results[fallback]
         if parsed:
             return TSHResponse(
                 ok=True,
@@ -185,13 +355,12 @@ async def ocr_tsh(
                 ref_min=parsed.ref_min,
                 ref_max=parsed.ref_max,
                 confidence=parsed.confidence,
-                raw_text=raw_text,
+                raw_text=_response_raw_text(raw_text, include_raw_text),
             )
 
         # Rien n'a marché
         return TSHResponse(
             ok=False,
             error=error or "TSH_NOT_FOUND",
-            raw_text=raw_text,
+            raw_text=_response_raw_text(raw_text, include_raw_text),
         )
-
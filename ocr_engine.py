@@ -1,104 +1,590 @@
+import hashlib
+import json
+import mmap
+import os
+import queue
+import threading
+import time
 import traceback
-from dataclasses import dataclass
-from typing import List, Optional
-
-from PIL import Image, ImageOps, ImageFilter
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from dataclasses import astuple, dataclass
+from operator import attrgetter
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+from PIL import Image, ImageChops, ImageFilter, ImageOps, ImageStat
+import pymupdf
 import pytesseract
-from pytesseract import Output
+
+from parsers.tsh import premium_parse_tsh
+
+try:
+    # Bindings C de libtesseract : le moteur reste chargé entre deux requêtes.
+    # Optionnel (compilation contre les en-têtes libtesseract/leptonica,
+    # installé par le Dockerfile) ; sans lui, pytesseract
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
 TESS_LANG = "fra+eng"
-TESS_BASE_CONFIG = "-c preserve_interword_spaces=1 tessedit_do_invert=0"
+TESS_BASE_CONFIG = "-c preserve_interword_spaces=1 -c tessedit_do_invert=0"
+
+# PSM 6 (un bloc de texte uniforme) + OEM 1 (LSTM seul) : le bon réglage
+# pour un bilan bio ; config pytesseract figée une fois pour toutes
+TESS_PSM = 6
+TESS_CONFIG = f"--oem 1 --psm {TESS_PSM} -l {TESS_LANG} {TESS_BASE_CONFIG}"
+TESS_VARIABLES = {"preserve_interword_spaces": "1", "tessedit_do_invert": "0"}
+
+# Résolution de rastérisation des PDF (300 dpi suffit à Tesseract)
+PDF_DPI = 300
+
+# Pages rastérisées au plus pour un PDF scanné : la TSH n'est pas toujours
+# en page 1 d'un bilan, mais chaque page coûte une passe Tesseract
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "6"))
+
+
+@dataclass(slots=True)
+class Box:
+    """Un mot reconnu par Tesseract et sa position (pixels)."""
+    text: str
+    left: int
+    top: int
+    width: int
+    height: int
+    conf: float
 
 
 @dataclass
 class OCRResult:
     raw_text: str
-    boxes: List[dict]
+    boxes: List[Box]
+
+
+def _is_pdf(path: str) -> bool:
+    """Détection du PDF par sa signature (l'extension n'est pas fiable)."""
+    with open(path, "rb") as f:
+        return f.read(5) == b"%PDF-"
+
+
+def _render_pdf_pages(path: str) -> Iterator[Image.Image]:
+    """
+    Rastérisation des pages d'un PDF par MuPDF (en process, pas de
+    poppler), directement en niveaux de gris et à la résolution utile à
+    Tesseract. Une page à la fois, PDF_MAX_PAGES au plus.
+    """
+    with pymupdf.open(path) as doc:
+        for i in range(min(doc.page_count, PDF_MAX_PAGES)):
+            pix = doc.load_page(i).get_pixmap(
+                dpi=PDF_DPI, colorspace=pymupdf.csGRAY
+            )
+            yield Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+
+def _pdf_text_layer(path: str) -> str:
+    """
+    Texte natif d'un PDF (bilan exporté par le labo, pas un scan), toutes
+    pages, extrait par MuPDF. Chaîne vide si le PDF n'a pas de couche
+    texte : il faut alors passer par l'OCR.
+    """
+    with pymupdf.open(path) as doc:
+        return "\n".join(page.get_text("text") for page in doc)
+
+
+# Résolution minimale (px, par côté) à conserver au décodage JPEG pour
+# light / premium (preprocess_for_bio réduit ensuite à 1600 px)
+LOAD_MAX_SIDE = 1600
 
 
-def _load_image(path: str) -> Image.Image:
+def _load_image(path: str, draft_side: Optional[int] = None) -> Image.Image:
     """
-    Chargement robuste de l'image source.
+    Chargement robuste de l'image source, directement en niveaux de gris
+    8 bits (1 octet/pixel) : la couleur ne sert à rien à l'OCR.
+    Les scans déjà binarisés (TIFF G4, mode "1") restent en 1 bit.
+
+    `draft_side` : si donné, un JPEG est décodé réduit (1/2, 1/4, 1/8) par
+    libjpeg en gardant les deux côtés >= draft_side. Sans lui (optimum),
+    pleine résolution.
     """
     im = Image.open(path)
-    return im.convert("RGB")
+    if draft_side and im.format == "JPEG":
+        # Décodage directement en gris et réduit : inutile de décoder
+        # 4000 px pour en jeter la majeure partie au resize
+        im.draft("L", (draft_side, draft_side))
+    if im.mode in ("1", "L"):
+        # déjà au bon format : convert() ferait une copie complète inutile
+        im.load()
+        return im
+    return im.convert("L")
+
+
+def _load_pages(
+    path: str, tag: str, draft_side: Optional[int] = None
+) -> Iterator[Image.Image]:
+    """
+    Pages à OCRiser : toutes celles d'un PDF (PDF_MAX_PAGES au plus),
+    l'image elle-même sinon. Une erreur de chargement est loggée et
+    termine l'itération.
+    """
+    try:
+        if _is_pdf(path):
+            pages: Iterable[Image.Image] = _render_pdf_pages(path)
+        else:
+            pages = (_load_image(path, draft_side),)
+        for img in pages:
+            yield img
+    except Exception as e:
+        print(f"{tag} ERROR: failed to load image:", e)
+        print(traceback.format_exc())
 
 
-def preprocess_for_bio(im: Image.Image) -> Image.Image:
+def _resize_if_needed(
+    im: Image.Image,
+    max_side: int = 1600,
+    box: Optional[Tuple[int, int, int, int]] = None,
+) -> Image.Image:
+    """
+    Réduit l'image (ou la zone `box` de l'image) si son plus grand côté
+    dépasse `max_side`. Avec `box`, recadrage et réduction se font en un
+    seul rééchantillonnage, sans image intermédiaire.
+    Filtre BOX (moyenne par zone) : le bon filtre pour une réduction,
+    bien moins coûteux que LANCZOS pour un rendu équivalent à l'OCR.
+    """
+    if box is None:
+        box = (0, 0) + im.size
+    w = box[2] - box[0]
+    h = box[3] - box[1]
+    m = max(w, h)
+    if m <= max_side:
+        return im if (w, h) == im.size else im.crop(box)
+    r = max_side / m
+    return im.resize((int(w * r), int(h * r)), Image.BOX, box=box)
+
+
+def _upscale(im: Image.Image, scale: float) -> Image.Image:
+    """
+    Agrandissement (petites polices). BICUBIC suffit pour un facteur
+    modeste et coûte moins cher que LANCZOS.
+    """
+    w, h = im.size
+    return im.resize((int(w * scale), int(h * scale)), Image.BICUBIC)
+
+
+def _otsu_level(hist: List[int]) -> int:
+    """
+    Seuil d'Otsu calculé sur l'histogramme 256 niveaux (PIL .histogram()) :
+    maximise la variance inter-classes texte / fond.
+    """
+    total = sum(hist)
+    if not total:
+        return 127
+    sum_all = sum(i * c for i, c in enumerate(hist))
+
+    w_back = 0
+    sum_back = 0
+    best = -1.0
+    level = 127
+    for i, c in enumerate(hist):
+        w_back += c
+        if not w_back:
+            continue
+        w_fore = total - w_back
+        if not w_fore:
+            break
+        sum_back += i * c
+        diff = sum_back / w_back - (sum_all - sum_back) / w_fore
+        between = w_back * w_fore * diff * diff
+        if between > best:
+            best = between
+            level = i
+    return level
+
+
+def _binarize(gray: Image.Image, level: int) -> Image.Image:
+    """
+    Seuillage via une LUT 256 entrées : un seul passage en C sur l'image.
+    Sortie en mode "1" (1 bit/pixel), accepté tel quel par Tesseract.
+    """
+    lut = [255 if i > level else 0 for i in range(256)]
+    return gray.point(lut, "1")
+
+
+def _adaptive_binarize(
+    gray: Image.Image, radius: int = 20, offset: int = 10
+) -> Image.Image:
+    """
+    Seuillage local (moyenne sur une fenêtre de rayon `radius`) : un pixel
+    est du texte s'il est plus sombre que son voisinage d'au moins `offset`.
+    Résiste aux éclairages inégaux (photos de bilans au smartphone) là où
+    un seuil global efface des zones entières.
+    """
+    local_mean = gray.filter(ImageFilter.BoxBlur(radius))
+    # max(moyenne locale - pixel, 0) : écart des pixels plus sombres
+    darker = ImageChops.subtract(local_mean, gray)
+    lut = [0 if i > offset else 255 for i in range(256)]
+    return darker.point(lut, "1")
+
+
+# Écart-type (niveaux de gris) sous lequel l'image est jugée peu
+# contrastée : seuillage adaptatif plutôt qu'Otsu
+LOW_CONTRAST_STDDEV = 40
+
+
+def _binarize_auto(
+    gray: Image.Image, method: Optional[str] = None
+) -> Image.Image:
+    """
+    Binarisation "otsu" (seuil global) ou "adaptive" (seuil local).
+    Sans `method`, adaptatif si l'image est peu contrastée, Otsu sinon ;
+    un seul histogramme sert aux deux décisions.
+
+    L'autocontraste (étirement linéaire min..max -> 0..255) est intégré
+    au calcul plutôt qu'appliqué à l'image : Otsu n'y est pas sensible,
+    l'écart-type et l'écart du seuil local sont simplement remis à
+    l'échelle. Une passe complète sur l'image en moins.
+    """
+    hist = gray.histogram()
+    stat = ImageStat.Stat(hist)
+    lo, hi = stat.extrema[0]
+    stretch = 255 / (hi - lo) if hi > lo else 1.0
+
+    if method is None:
+        low_contrast = stat.stddev[0] * stretch < LOW_CONTRAST_STDDEV
+        method = "adaptive" if low_contrast else "otsu"
+    if method == "adaptive":
+        return _adaptive_binarize(gray, offset=max(1, round(10 / stretch)))
+    return _binarize(gray, _otsu_level(hist))
+
+
+def preprocess_for_bio(im: Image.Image, top_crop: float = 0.35) -> Image.Image:
     """
     Pré-traitement spécifique bilans bio :
 
       - on garde surtout le bas du document (là où sont les valeurs),
-      - niveaux de gris + autocontraste,
-      - léger sharpen,
-      - redimensionnement (uniquement si très grand) pour accélérer l'OCR.
+      - niveaux de gris,
+      - redimensionnement (uniquement si très grand) pour accélérer l'OCR,
+      - binarisation d'Otsu (un seul passage, remplace autocontraste +
+        sharpen : Tesseract binarise de toute façon son entrée).
+
+    Un scan déjà binarisé (mode "1") qui ne demande pas de réduction est
+    seulement recadré : ni gris ni Otsu, Tesseract reçoit le bitmap tel quel.
+
+    `top_crop` : part du haut de page coupée (en-tête du labo) ; 0 pour les
+    pages d'un PDF après la première, qui n'ont pas cet en-tête.
     """
     w, h = im.size
+    crop_box = (0, int(h * top_crop), w, h)
 
-    # Conserver le bas de la page (0.35 = partie haute coupée)
-    cropped = im.crop((0, int(h * 0.35), w, h))
+    if im.mode == "1" and max(w, h - crop_box[1]) <= 1600:
+        return im.crop(crop_box)
 
-    # Gris + autocontraste
-    gray = ImageOps.grayscale(cropped)
-    gray = ImageOps.autocontrast(gray)
+    # Gris (_load_image renvoie déjà du mode L : pas de copie dans ce cas)
+    if im.mode != "L":
+        im = ImageOps.grayscale(im)
 
-    # Sharpen léger
-    gray = gray.filter(ImageFilter.SHARPEN)
+    # Conserver le bas de la page (top_crop = partie haute coupée), réduit
+    # dans le même passage si l'image est très grande
+    gray = _resize_if_needed(im, max_side=1600, box=crop_box)
 
-    # Resize uniquement si l'image est très grande
-    max_side = 1600
-    w2, h2 = gray.size
-    m = max(w2, h2)
-    if m > max_side:
-        r = max_side / m
-        gray = gray.resize((int(w2 * r), int(h2 * r)), Image.LANCZOS)
+    # Binarisation d'Otsu sur l'image réduite
+    return _binarize(gray, _otsu_level(gray.histogram()))
 
-    return gray
 
+# --------------------------------------------------------------------------
+# Moteur Tesseract persistant (tesserocr)
+# --------------------------------------------------------------------------
 
-def _run_tesseract_string(img: Image.Image, psm: int = 6) -> str:
+def _usable_cpus() -> int:
     """
-    Exécution Tesseract pour récupérer le texte brut.
+    CPU utilisables par le process (affinité / cpuset du conteneur), et non
+    ceux de l'hôte qu'annonce os.cpu_count(). Un quota CFS (docker --cpus)
+    n'y apparaît pas : le fixer alors via OCR_WORKERS.
     """
-    config = f"{TESS_BASE_CONFIG} --psm {psm} -l {TESS_LANG}"
-    return pytesseract.image_to_string(img, config=config)
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        # pas de sched_getaffinity (macOS)
+        return os.cpu_count() or 1
+
+
+# Passes OCR simultanées par worker uvicorn : taille du pool Tesseract ici,
+# et du sémaphore OCR_SEMAPHORE dans app.py
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "0")) or _usable_cpus()
+
+# Une instance PyTessBaseAPI par passe OCR simultanée (l'API n'est pas
+# thread-safe, mais libtesseract relâche le GIL : N instances = N cœurs)
+TESS_POOL_SIZE = OCR_WORKERS
+
+_tess_pool: "queue.Queue" = queue.Queue()
+_tess_pool_created = 0
+_tess_pool_lock = threading.Lock()
 
 
-def _run_tesseract_data(img: Image.Image, psm: int = 6) -> List[dict]:
+def _new_tess_api():
     """
-    Exécution Tesseract pour récupérer les boxes (image_to_data).
-    Retourne une liste de dicts {text,left,top,width,height,conf}.
+    Nouvelle instance PyTessBaseAPI, modèles fra+eng chargés une fois
+    pour toute la durée de vie du process. Moteur LSTM seul : le moteur
+    legacy n'est jamais initialisé (ni ses modèles chargés).
     """
-    config = f"{TESS_BASE_CONFIG} --psm {psm} -l {TESS_LANG}"
-    data = pytesseract.image_to_data(
-        img,
-        config=config,
-        output_type=Output.DICT,
+    api = tesserocr.PyTessBaseAPI(
+        lang=TESS_LANG,
+        psm=tesserocr.PSM.SINGLE_BLOCK,
+        oem=tesserocr.OEM.LSTM_ONLY,
     )
+    for name, value in TESS_VARIABLES.items():
+        api.SetVariable(name, value)
+    return api
+
+
+def _reserve_tess_slots(n: int) -> int:
+    """Réserve jusqu'à n créations d'instances dans la limite du pool."""
+    global _tess_pool_created
+    with _tess_pool_lock:
+        n = max(0, min(n, TESS_POOL_SIZE - _tess_pool_created))
+        _tess_pool_created += n
+    return n
+
+
+def _release_tess_slot() -> None:
+    global _tess_pool_created
+    with _tess_pool_lock:
+        _tess_pool_created -= 1
+
+
+@contextmanager
+def _tess_api():
+    """
+    Emprunte une instance au pool (créée à la demande tant que le pool
+    n'est pas plein, sinon on attend qu'une instance se libère).
+    """
+    try:
+        api = _tess_pool.get_nowait()
+    except queue.Empty:
+        if _reserve_tess_slots(1):
+            try:
+                api = _new_tess_api()
+            except Exception:
+                _release_tess_slot()
+                raise
+        else:
+            api = _tess_pool.get()
+    try:
+        yield api
+    finally:
+        _tess_pool.put(api)
+
+
+def warmup_tesseract() -> None:
+    """
+    Remplit le pool au démarrage du serveur, pour que les premières
+    requêtes ne paient pas le chargement des modèles.
+    Sans tesserocr (fallback pytesseract), ne fait rien.
+    """
+    if tesserocr is None:
+        return
+    for _ in range(_reserve_tess_slots(TESS_POOL_SIZE)):
+        try:
+            _tess_pool.put(_new_tess_api())
+        except Exception:
+            _release_tess_slot()
+            raise
+
+
+def shutdown_tesseract() -> None:
+    """Libère les instances du pool (arrêt du serveur)."""
+    while True:
+        try:
+            api = _tess_pool.get_nowait()
+        except queue.Empty:
+            break
+        api.End()
+        _release_tess_slot()
+
+
+# Accès aux champs de Box en C (clé de tri / join des lignes du TSV)
+_box_text = attrgetter("text")
+_box_left = attrgetter("left")
 
-    boxes: List[dict] = []
-    n = len(data.get("text", []))
-    confs = data.get("conf", [0] * n)
 
-    for i in range(n):
-        txt = data["text"][i]
+def _tess_words(api) -> List[Box]:
+    """
+    Parcourt les mots reconnus par l'API (après Recognize) et retourne
+    une liste de Box(text,left,top,width,height,conf).
+    """
+    level = tesserocr.RIL.WORD
+    boxes: List[Box] = []
+    for word in tesserocr.iterate_level(api.GetIterator(), level):
+        txt = word.GetUTF8Text(level)
         if not txt or not txt.strip():
             continue
+        bbox = word.BoundingBox(level)
+        if not bbox:
+            continue
+        x1, y1, x2, y2 = bbox
+        boxes.append(
+            Box(txt, x1, y1, x2 - x1, y2 - y1, float(word.Confidence(level)))
+        )
+    return boxes
+
+
+def _as_pnm(img: Image.Image) -> Image.Image:
+    """
+    pytesseract passe l'image au binaire tesseract via un fichier temporaire
+    écrit au format `img.format` (PNG par défaut : compression Deflate, puis
+    décompression côté tesseract). En PNM binaire (P4/P5), l'écriture et la
+    relecture ne sont qu'une copie des pixels.
+    """
+    if img.mode in ("1", "L"):
+        img.format = "PPM"
+    return img
+
+
+def _set_tess_image(api, img: Image.Image) -> None:
+    """
+    Donne l'image à l'API tesserocr en pixels bruts (SetImageBytes) :
+    SetImage l'encoderait au format `img.format` (PNG par défaut) pour
+    que Tesseract la décode aussitôt.
+    """
+    if img.mode == "1":
+        # 1 bit côté Pillow : 1 = blanc, l'inverse de Leptonica -> 8 bits
+        img = img.convert("L")
+    if img.mode == "L":
+        api.SetImageBytes(img.tobytes(), img.width, img.height, 1, img.width)
+    else:
+        api.SetImage(img)
+
+
+def _tess_config(psm: int) -> str:
+    """Config pytesseract ; TESS_CONFIG tel quel pour le PSM par défaut."""
+    if psm == TESS_PSM:
+        return TESS_CONFIG
+    return f"--oem 1 --psm {psm} -l {TESS_LANG} {TESS_BASE_CONFIG}"
+
+
+def _run_tesseract_string(img: Image.Image, psm: int = TESS_PSM) -> str:
+    """
+    Exécution Tesseract pour récupérer le texte brut.
+    """
+    if tesserocr is not None:
+        with _tess_api() as api:
+            api.SetPageSegMode(psm)
+            _set_tess_image(api, img)
+            return api.GetUTF8Text()
+
+    config = _tess_config(psm)
+    return pytesseract.image_to_string(_as_pnm(img), config=config)
+
+
+def _run_tesseract_text_and_boxes(
+    img: Image.Image, psm: int = TESS_PSM
+) -> Tuple[str, List[Box]]:
+    """
+    Un seul passage Tesseract pour le texte ET les boxes.
+
+    Le texte brut est reconstruit à partir des mots de image_to_data,
+    regroupés par (block_num, par_num, line_num) : inutile de relancer
+    image_to_string sur la même image.
+    Retourne (raw_text, boxes) avec boxes : liste de Box.
+    """
+    if tesserocr is not None:
+        with _tess_api() as api:
+            api.SetPageSegMode(psm)
+            _set_tess_image(api, img)
+            api.Recognize()
+            # GetUTF8Text réutilise la reconnaissance faite par Recognize
+            return api.GetUTF8Text(), _tess_words(api)
+
+    config = _tess_config(psm)
+    # TSV brut : Output.DICT convertirait chaque cellule de chaque ligne
+    # (niveaux page/bloc/ligne vides compris) avant qu'on filtre les mots
+    tsv = pytesseract.image_to_data(_as_pnm(img), config=config)
+
+    boxes: List[Box] = []
+    lines = defaultdict(list)
+
+    rows = iter(tsv.splitlines())
+    header = next(rows, "").split("\t")
+    try:
+        i_block = header.index("block_num")
+        i_par = header.index("par_num")
+        i_line = header.index("line_num")
+        i_left = header.index("left")
+        i_top = header.index("top")
+        i_width = header.index("width")
+        i_height = header.index("height")
+        i_conf = header.index("conf")
+        i_text = header.index("text")
+    except ValueError:
+        print("OCR ERROR: unexpected image_to_data header:", header)
+        return "", []
+
+    for row in rows:
+        cols = row.split("\t")
+        if len(cols) <= i_text:
+            continue
+        txt = cols[i_text]
+        if not txt.strip():
+            continue
         try:
-            boxes.append(
-                {
-                    "text": txt,
-                    "left": int(data["left"][i]),
-                    "top": int(data["top"][i]),
-                    "width": int(data["width"][i]),
-                    "height": int(data["height"][i]),
-                    "conf": float(confs[i]),
-                }
+            box = Box(
+                txt,
+                int(cols[i_left]),
+                int(cols[i_top]),
+                int(cols[i_width]),
+                int(cols[i_height]),
+                float(cols[i_conf]),
             )
         except Exception:
             # on ignore les boxes mal formées
             continue
-    return boxes
+        boxes.append(box)
+        lines[(cols[i_block], cols[i_par], cols[i_line])].append(box)
+
+    raw_text = "\n".join(
+        " ".join(map(_box_text, sorted(words, key=_box_left)))
+        for words in lines.values()
+    )
+    return raw_text, boxes
+
+
+def _preprocessed_pages(path: str, tag: str) -> Iterator[Image.Image]:
+    """
+    _load_pages + preprocess_for_bio (light et premium), page par page.
+    Seule la 1re page perd son en-tête ; image brute si le pré-traitement
+    échoue.
+    """
+    for i, img in enumerate(_load_pages(path, tag, draft_side=LOAD_MAX_SIDE)):
+        try:
+            img = preprocess_for_bio(img, top_crop=0.35 if i == 0 else 0.0)
+        except Exception as e:
+            print(f"{tag} ERROR: preprocessing failed:", e)
+            print(traceback.format_exc())
+            # on tente quand même avec l'image brute
+        yield img
+
+
+def _ocr_pages(
+    pages: Iterable[Image.Image],
+    ocr_page: Callable[[Image.Image], Tuple[str, List[Box]]],
+) -> Tuple[str, List[Box]]:
+    """
+    OCR page par page : textes joints, boxes mis bout à bout (coordonnées
+    relatives à leur page). On s'arrête à la première page où la TSH est
+    trouvée : les pages suivantes d'un PDF ne sont ni rastérisées ni lues.
+    """
+    texts: List[str] = []
+    boxes: List[Box] = []
+    for img in pages:
+        text, page_boxes = ocr_page(img)
+        texts.append(text or "")
+        boxes.extend(page_boxes)
+        if premium_parse_tsh("\n".join(texts), boxes).ok:
+            break
+    return "\n".join(texts), boxes
+
+
+def _tesseract_text_only(img: Image.Image) -> Tuple[str, List[Box]]:
+    """Passe Tesseract texte seul (light), au format de _ocr_pages."""
+    return _run_tesseract_string(img), []
 
 
 # --------------------------------------------------------------------------
@@ -113,32 +599,18 @@ def light_extract_text(path: str) -> Optional[OCRResult]:
       - un seul passage Tesseract pour le texte brut
       - pas de récupération des boxes
 
-    Utilisée comme premier essai rapide ; si le parsing TSH échoue,
-    on bascule sur premium puis optimum.
+    Premier essai rapide du mode auto (AUTO_LEVELS dans app.py) : si
+    elle ne donne pas une TSH avec bornes, optimum prend le relais.
     """
     try:
-        img = _load_image(path)
-    except Exception as e:
-        print("OCR-LIGHT ERROR: failed to load image:", e)
-        print(traceback.format_exc())
-        return None
-
-    try:
-        img = preprocess_for_bio(img)
-    except Exception as e:
-        print("OCR-LIGHT ERROR: preprocessing failed:", e)
-        print(traceback.format_exc())
-        # on tente quand même avec l'image brute
-        pass
-
-    try:
-        raw_text = _run_tesseract_string(img, psm=6)
+        raw_text, _ = _ocr_pages(
+            _preprocessed_pages(path, "OCR-LIGHT"), _tesseract_text_only
+        )
     except Exception as e:
         print("OCR-LIGHT ERROR: image_to_string failed:", e)
         print(traceback.format_exc())
         return None
 
-    raw_text = raw_text or ""
     if not raw_text.strip():
         print("OCR-LIGHT ERROR: empty text")
         return None
@@ -154,45 +626,20 @@ def premium_extract_text(path: str) -> Optional[OCRResult]:
     """
     Pipeline OCR optimisé :
 
-      1. Chargement robuste de l'image.
+      1. Chargement robuste de l'image (pages d'un PDF scanné).
       2. Pré-traitement spécifique bilans bio.
-      3. Un passage Tesseract pour le texte.
-      4. Un passage Tesseract pour les boxes.
+      3. Un seul passage Tesseract pour le texte et les boxes.
     """
-    # 1) Load
-    try:
-        img = _load_image(path)
-    except Exception as e:
-        print("OCR ERROR: failed to load image:", e)
-        print(traceback.format_exc())
-        return None
+    # 1-2) Load + preprocess (même helper que light)
+    pages = _preprocessed_pages(path, "OCR")
 
-    # 2) Preprocess
+    # 3) OCR texte + boxes en un seul passage par page
     try:
-        img = preprocess_for_bio(img)
-    except Exception as e:
-        print("OCR ERROR: preprocessing failed:", e)
-        print(traceback.format_exc())
-        # On continue quand même avec l'image brute
-        pass
-
-    # 3) OCR texte brut
-    try:
-        raw_text = _run_tesseract_string(img, psm=6)
-    except Exception as e:
-        print("OCR ERROR: image_to_string failed:", e)
-        print(traceback.format_exc())
-        raw_text = ""
-
-    raw_text = raw_text or ""
-
-    # 4) OCR boxes
-    try:
-        boxes = _run_tesseract_data(img, psm=6)
+        raw_text, boxes = _ocr_pages(pages, _run_tesseract_text_and_boxes)
     except Exception as e:
         print("OCR ERROR: image_to_data failed:", e)
         print(traceback.format_exc())
-        boxes = []
+        raw_text, boxes = "", []
 
     if (not raw_text.strip()) and not boxes:
         print("OCR ERROR: empty result (no text, no boxes)")
@@ -205,66 +652,273 @@ def premium_extract_text(path: str) -> Optional[OCRResult]:
 # NIVEAU 3 : OCR OPTIMUM (images difficiles, upscaling + binarisation)
 # --------------------------------------------------------------------------
 
-def optimum_extract_text(path: str) -> Optional[OCRResult]:
-    """
-    Version 'optimum' pour les bilans compliqués :
+# Plus petit côté (px) en dessous duquel optimum agrandit l'image
+OPTIMUM_UPSCALE_BELOW = 2000
 
-      - upscale de l'image
-      - binarisation plus agressive
-      - récupération du texte et des boxes
 
-    Plus lente, mais utile en dernier recours.
-    """
+def _optimum_page(img: Image.Image) -> Tuple[str, List[Box]]:
+    """Pré-traitement optimum d'une page, puis OCR texte + boxes."""
+    # 1) Gris (déjà le cas via _load_image) ; l'autocontraste est intégré
+    #    à la binarisation (_binarize_auto)
     try:
-        img = _load_image(path)
+        if img.mode != "L":
+            img = ImageOps.grayscale(img)
     except Exception as e:
-        print("OCR-OPTIMUM ERROR: failed to load image:", e)
+        print("OCR-OPTIMUM ERROR: grayscale failed:", e)
         print(traceback.format_exc())
-        return None
 
-    # 1) Upscale x1.5 pour les petites polices
+    # 2) Upscale x1.5 pour les petites polices (inutile sur une grande image)
     try:
-        w, h = img.size
-        scale = 1.5
-        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
+        if min(img.size) < OPTIMUM_UPSCALE_BELOW:
+            img = _upscale(img, 1.5)
     except Exception as e:
         print("OCR-OPTIMUM ERROR: upscale failed:", e)
         print(traceback.format_exc())
 
-    # 2) Prétraitement + binarisation agressive
+    # 3) Binarisation : Otsu, ou seuillage local si l'image est peu
+    #    contrastée (éclairage inégal)
     try:
-        gray = ImageOps.grayscale(img)
-        gray = ImageOps.autocontrast(gray)
-
-        def _threshold(p):
-            return 255 if p > 160 else 0
-
-        bin_img = gray.point(_threshold)
+        bin_img = _binarize_auto(img)
     except Exception as e:
         print("OCR-OPTIMUM ERROR: binarization failed:", e)
         print(traceback.format_exc())
         bin_img = img
 
-    # 3) OCR texte brut
-    try:
-        raw_text = _run_tesseract_string(bin_img, psm=6)
-    except Exception as e:
-        print("OCR-OPTIMUM ERROR: image_to_string failed:", e)
-        print(traceback.format_exc())
-        raw_text = ""
+    # 4) OCR texte + boxes en un seul passage
+    return _run_tesseract_text_and_boxes(bin_img)
 
-    raw_text = raw_text or ""
 
-    # 4) OCR boxes (on réutilise _run_tesseract_data qui renvoie une liste de dicts)
+def optimum_extract_text(path: str) -> Optional[OCRResult]:
+    """
+    Version 'optimum' pour les bilans compliqués :
+
+      - upscale de l'image (pleine page, pleine résolution)
+      - binarisation Otsu ou adaptative selon le contraste
+      - récupération du texte et des boxes
+
+    Plus lente, mais utile en dernier recours.
+    """
     try:
-        boxes = _run_tesseract_data(bin_img, psm=6)
+        raw_text, boxes = _ocr_pages(
+            _load_pages(path, "OCR-OPTIMUM"), _optimum_page
+        )
     except Exception as e:
         print("OCR-OPTIMUM ERROR: image_to_data failed:", e)
         print(traceback.format_exc())
-        boxes = []
+        raw_text, boxes = "", []
 
     if (not raw_text.strip()) and not boxes:
         print("OCR-OPTIMUM ERROR: empty result (no text, no boxes)")
         return None
 
     return OCRResult(raw_text=raw_text, boxes=boxes)
+
+
+# --------------------------------------------------------------------------
+# CACHE : résultat OCR par contenu de fichier
+# --------------------------------------------------------------------------
+
+EXTRACTORS = {
+    "light": light_extract_text,
+    "premium": premium_extract_text,
+    "optimum": optimum_extract_text,
+}
+
+OCR_CACHE_SIZE = 256
+
+# Niveaux dont le résultat en cache peut servir pour un autre : premium
+# fait la même passe que light (même pré-traitement) et renvoie en plus
+# les boxes -> un light après un premium ne relance pas Tesseract
+CACHE_EQUIVALENTS = {"light": ("premium",)}
+
+# 2e niveau de cache, sur disque : survit aux redémarrages et est partagé
+# entre workers uvicorn. Désactivé par défaut (OCR_CACHE_DIR vide) : il
+# contient le texte des bilans, à placer dans un répertoire dédié.
+OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "")
+
+# Bornes du cache disque : nombre d'entrées (LRU, l'mtime est rafraîchi à
+# chaque lecture) et âge max en secondes
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "2000"))
+OCR_CACHE_MAX_AGE = int(os.getenv("OCR_CACHE_MAX_AGE", str(7 * 24 * 3600)))
+
+# À incrémenter à chaque changement du pipeline (pré-traitement, réglages
+# Tesseract) : invalide les résultats déjà sur disque
+PIPELINE_VERSION = "3"
+
+_ocr_cache: "OrderedDict[Tuple[str, str], OCRResult]" = OrderedDict()
+_ocr_cache_lock = threading.Lock()
+
+
+def file_digest(path: str) -> str:
+    """
+    Empreinte blake2b (128 bits) du contenu du fichier, lu via mmap
+    (pas de copie du fichier en mémoire Python).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+    return h.hexdigest()
+
+
+def _remember(key: Tuple[str, str], result: OCRResult) -> None:
+    """Ajoute au cache mémoire (LRU borné à OCR_CACHE_SIZE)."""
+    with _ocr_cache_lock:
+        _ocr_cache[key] = result
+        _ocr_cache.move_to_end(key)
+        while len(_ocr_cache) > OCR_CACHE_SIZE:
+            _ocr_cache.popitem(last=False)
+
+
+def _cached(digest: str, level: str) -> Optional[OCRResult]:
+    """Résultat en cache (mémoire, puis disque) pour (digest, level)."""
+    key = (digest, level)
+    with _ocr_cache_lock:
+        cached = _ocr_cache.get(key)
+        if cached is not None:
+            _ocr_cache.move_to_end(key)
+            return cached
+
+    cached = _disk_cache_get(digest, level)
+    if cached is not None:
+        _remember(key, cached)
+    return cached
+
+
+def _disk_cache_path(digest: str, level: str) -> str:
+    return os.path.join(OCR_CACHE_DIR, f"{digest}-{PIPELINE_VERSION}-{level}.json")
+
+
+def _disk_cache_get(digest: str, level: str) -> Optional[OCRResult]:
+    if not OCR_CACHE_DIR:
+        return None
+    path = _disk_cache_path(digest, level)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        # entrée utilisée : remonte en tête pour l'éviction LRU
+        os.utime(path)
+        return OCRResult(
+            raw_text=data["raw_text"],
+            boxes=[Box(*b) for b in data["boxes"]],
+        )
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # entrée illisible : on refait l'OCR (elle sera réécrite)
+        print("OCR CACHE ERROR: failed to read entry:", e)
+        return None
+
+
+def _disk_cache_put(digest: str, level: str, result: OCRResult) -> None:
+    if not OCR_CACHE_DIR:
+        return
+    path = _disk_cache_path(digest, level)
+    data = {
+        "raw_text": result.raw_text,
+        "boxes": [astuple(b) for b in result.boxes],
+    }
+    # écriture atomique : un lecteur concurrent ne voit jamais de fichier
+    # à moitié écrit. Données de patients -> répertoire 0700, fichiers 0600
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(OCR_CACHE_DIR, mode=0o700, exist_ok=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, path)
+    except Exception as e:
+        print("OCR CACHE ERROR: failed to write entry:", e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return
+
+    try:
+        _disk_cache_prune()
+    except Exception as e:
+        print("OCR CACHE ERROR: eviction failed:", e)
+
+
+def _disk_cache_prune() -> None:
+    """
+    Éviction du cache disque : supprime les fichiers plus vieux que
+    OCR_CACHE_MAX_AGE (y compris des .tmp orphelins), puis les entrées
+    les moins récemment utilisées au-delà de OCR_CACHE_MAX_ENTRIES.
+    """
+    expire = time.time() - OCR_CACHE_MAX_AGE
+    entries = []
+    with os.scandir(OCR_CACHE_DIR) as it:
+        for entry in it:
+            if not entry.is_file():
+                continue
+            mtime = entry.stat().st_mtime
+            if mtime < expire:
+                _unlink_quiet(entry.path)
+            elif entry.name.endswith(".json"):
+                entries.append((mtime, entry.path))
+
+    excess = len(entries) - OCR_CACHE_MAX_ENTRIES
+    if excess > 0:
+        entries.sort()
+        for _, path in entries[:excess]:
+            _unlink_quiet(path)
+
+
+def _unlink_quiet(path: str) -> None:
+    """os.unlink, sans erreur si un autre worker l'a déjà supprimé."""
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def extract_text(
+    path: str, level: str, digest: Optional[str] = None
+) -> Optional[OCRResult]:
+    """
+    OCR au niveau demandé (light / premium / optimum), mémoïsé sur
+    (empreinte du fichier, niveau).
+
+    Un même bilan renvoyé (retry côté Bubble, mode auto) ne repasse pas
+    par Tesseract. Cache à deux niveaux : LRU en mémoire, puis fichiers
+    JSON dans OCR_CACHE_DIR. Seuls les succès sont mis en cache.
+
+    Pour light / premium, la couche texte d'un PDF est lue directement
+    (MuPDF) si la TSH s'y trouve ; sinon (scan avec seulement un en-tête
+    de portail, un n° de page ou l'OCR médiocre d'un copieur) on passe
+    par l'OCR. optimum, dernier recours, fait toujours l'OCR.
+    """
+    if digest is None:
+        digest = file_digest(path)
+    key = (digest, level)
+
+    for lvl in (level,) + CACHE_EQUIVALENTS.get(level, ()):
+        cached = _cached(digest, lvl)
+        if cached is not None:
+            return cached
+
+    result = None
+    if level != "optimum" and _is_pdf(path):
+        # PDF natif : le texte est déjà là, pas besoin de Tesseract
+        try:
+            text = _pdf_text_layer(path)
+        except Exception as e:
+            print("OCR ERROR: PDF text extraction failed:", e)
+            print(traceback.format_exc())
+            text = ""
+        # Couche texte gardée seulement si la TSH y est (parse mémoïsé :
+        # le parse qui suit dans app.py ne coûte rien de plus)
+        if text.strip() and premium_parse_tsh(text, []).ok:
+            result = OCRResult(raw_text=text, boxes=[])
+
+    if result is None:
+        result = EXTRACTORS[level](path)
+    if result is None:
+        return None
+
+    _disk_cache_put(digest, level, result)
+    _remember(key, result)
+    return result
@@ -1,5 +1,6 @@
 import re
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Optional, List, Tuple
 
 
@@ -7,7 +8,7 @@ from typing import Optional, List, Tuple
 # Structures de données
 # --------------------------------------------------------------------
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class ParsedTSH:
     ok: bool
     value: Optional[float] = None
@@ -18,7 +19,7 @@ class ParsedTSH:
     error: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class TSHMatch:
     label: str
     value: float
@@ -27,27 +28,66 @@ class TSHMatch:
     ref_max: Optional[float]
     span: Tuple[int, int]
     raw_line: str
-    raw_snippet: str
+    # Qualité du label (0 = meilleur), calculée une fois à la construction
+    label_penalty: int
+    snippet_start: int = 0
+
+    @property
+    def raw_snippet(self) -> str:
+        """Partie de la ligne analysée (découpée à la demande seulement)."""
+        return self.raw_line[self.snippet_start:]
 
 
 # --------------------------------------------------------------------
 # Helpers
 # --------------------------------------------------------------------
 
+_SPACES_RE = re.compile(r"[ \t\f\v]+")
+# \r isolés, \r\n et lignes vides -> un seul \n
+_NEWLINES_RE = re.compile(r"[\r\n]+")
+
+
 def _normalize_text(text: str) -> str:
     """Nettoyage léger du texte OCR."""
     if not text:
         return ""
-    text = text.replace("\r", "\n")
-    text = re.sub(r"[ \t\f\v]+", " ", text)
-    text = re.sub(r"\n+", "\n", text)
-    return text
+    # Texte déjà propre (cas des lignes reconstruites depuis le TSV
+    # Tesseract) : quelques recherches de sous-chaînes, pas de copie
+    if (
+        "  " not in text
+        and "\n\n" not in text
+        and "\r" not in text
+        and "\t" not in text
+        and "\f" not in text
+        and "\v" not in text
+    ):
+        return text
+    text = _SPACES_RE.sub(" ", text)
+    return _NEWLINES_RE.sub("\n", text)
+
+
+def _label_penalty(label: str) -> int:
+    """Pénalité de label pour le score : TSH < thyr... < fallback < autre."""
+    l = label.lower()
+    if "fallback" in l:
+        return 2
+    if "tsh" in l:
+        return 0
+    if "thyr" in l:
+        return 1
+    return 3
 
 
 def _to_float(s: str) -> Optional[float]:
     """Convertit une chaîne en float (gère la virgule)."""
     if not s:
         return None
+    if "," not in s:
+        # Cas courant ("2.35", "4000") : float() direct, sans copies
+        try:
+            return float(s)
+        except ValueError:
+            pass
     s = s.replace(" ", "").replace("\u00a0", "")
     s = s.replace(",", ".")
     try:
@@ -56,6 +96,10 @@ def _to_float(s: str) -> Optional[float]:
         return None
 
 
+# Tout sauf les chiffres (signe éventuel des bornes de RANGE_RE)
+_NON_DIGITS_RE = re.compile(r"\D+")
+
+
 def _adjust_ref_value(raw: str) -> Optional[float]:
     """
     Corrige des références typiques OCR :
@@ -70,7 +114,7 @@ def _adjust_ref_value(raw: str) -> Optional[float]:
     if "," in raw or "." in raw:
         return _to_float(raw)
 
-    digits = "".join(ch for ch in raw if ch.isdigit())
+    digits = _NON_DIGITS_RE.sub("", raw)
     if not digits:
         return None
 
@@ -97,30 +141,50 @@ def _adjust_ref_value(raw: str) -> Optional[float]:
 # Regex pour détecter les labels & nombres
 # --------------------------------------------------------------------
 
-# Base "TSH" tolérant les points/espaces : T.S.H, T S H, TSH...
-BASE_TSH = r"T[.\s]*S[.\s]*H"
+# Quantificateurs possessifs (*+, ++ ; Python >= 3.11) partout où le
+# caractère suivant ne peut pas appartenir à la répétition : même résultat,
+# mais aucun retour arrière possible sur du bruit OCR.
 
+# Tous les labels commencent par T : facteur commun sorti de l'alternation,
+# le moteur ne teste les variantes qu'aux positions d'un T/t (et non plus
+# chacune des 6 branches à chaque caractère du texte). Même ordre d'essai.
 TSH_LABEL_PATTERN = (
-    r"(?:"
-    rf"{BASE_TSH}\s*3(?:e|ème)\s*g[ée]n[ée]?ration?"   # T.S.H 3ème génération
-    rf"|{BASE_TSH}\s*ultra\s*sensible"                # T.S.H ultra sensible
-    rf"|{BASE_TSH}\s*us\b"                            # T.S.Hus / TSHus
-    rf"|{BASE_TSH}\b"                                 # T.S.H / TSH simple
-    r"|thyr[eé]ostimuline"                            # thyréostimuline
-    r"|thyrotropine"                                  # thyrotropine
+    r"T(?:"
+    # Base "TSH" tolérant les points/espaces : T.S.H, T S H, TSH...
+    r"[.\s]*+S[.\s]*+H(?:"
+    r"\s*+3(?:e|ème)\s*+g[ée]n[ée]?ration?"          # T.S.H 3ème génération
+    r"|\s*+ultra\s*+sensible"                        # T.S.H ultra sensible
+    r"|\s*+us\b"                                     # T.S.Hus / TSHus
+    r"|\b"                                           # T.S.H / TSH simple
+    r")"
+    r"|hyr(?:[eé]ostimuline|otropine)"               # thyréostimuline, thyrotropine
     r")"
 )
 
 LABEL_RE = re.compile(TSH_LABEL_PATTERN, re.IGNORECASE)
 
-# Nombre avec . ou , (style FR/US)
-NUM_RE = re.compile(r"[+-]?\d+(?:[.,]\d+)?")
+# Unité TSH à côté de la valeur (mUI/L, µUI/mL, mIU/L...)
+UNIT_RE = re.compile(
+    r"(m ?UI/?L|µ ?UI/?L|u ?UI/?mL|mIU/?L|mU/?L|pUI/?mL|UI/?L|mUI|µUI|uUI)",
+    re.IGNORECASE,
+)
+
+# Même chose pour le fallback sans label (pas de pUI/mL)
+FALLBACK_UNIT_RE = re.compile(
+    r"(m ?UI/?L|µ ?UI/?L|u ?UI/?mL|mIU/?L|mU/?L|UI/?L|mUI|µUI|uUI)",
+    re.IGNORECASE,
+)
+
+# Nombre avec . ou , (style FR/US). re.ASCII : \d = [0-9], sans passer
+# par les tables Unicode (Tesseract fra ne sort que des chiffres ASCII)
+NUM_RE = re.compile(r"[+-]?\d++(?:[.,]\d++)?", re.ASCII)
 
 # Plage de références : x - y, x à y, x & y, etc.
+# [0-9] plutôt que re.ASCII : \s doit rester Unicode (espaces insécables)
 RANGE_RE = re.compile(
-    r"(?P<min>[+-]?\d+(?:[.,]\d+)?)\s*"
-    r"(?:-|–|—|~|à|a|to|&)\s*"
-    r"(?P<max>[+-]?\d+(?:[.,]\d+)?)"
+    r"(?P<min>[+-]?[0-9]++(?:[.,][0-9]++)?)\s*+"
+    r"(?:-|–|—|~|à|a|to|&)\s*+"
+    r"(?P<max>[+-]?[0-9]++(?:[.,][0-9]++)?)"
 )
 
 
@@ -139,32 +203,29 @@ def _extract_tsh_from_labelled_line(line: str) -> Optional[TSHMatch]:
         return None
 
     label = m.group(0)
-    snippet = line[m.end():]  # tout ce qu'il y a après le label
+    # Tout se cherche après le label, par position dans la ligne (pas de
+    # copie de la fin de ligne)
+    snippet_start = m.end()
 
     # 1) TSH value : premier nombre après le label
-    nums = list(NUM_RE.finditer(snippet))
-    if not nums:
+    tsh_num = NUM_RE.search(line, snippet_start)
+    if not tsh_num:
         return None
 
-    tsh_num = nums[0]
     tsh_value = _to_float(tsh_num.group())
     if tsh_value is None:
         return None
 
-    # 2) Unité éventuelle : autour de la valeur
+    # 2) Unité éventuelle : dans les 25 caractères après la valeur
+    #    (pos/endpos : pas de copie de la fenêtre)
+    after_pos = tsh_num.end()
     unit = None
-    unit_window = snippet[tsh_num.end():tsh_num.end() + 25]
-    unit_match = re.search(
-        r"(m ?UI/?L|µ ?UI/?L|u ?UI/?mL|mIU/?L|mU/?L|pUI/?mL|UI/?L|mUI|µUI|uUI)",
-        unit_window,
-        re.IGNORECASE,
-    )
+    unit_match = UNIT_RE.search(line, after_pos, after_pos + 25)
     if unit_match:
         unit = unit_match.group(0)
 
     # 3) Plage de référence : après la valeur TSH
-    after_pos = tsh_num.end()
-    range_match = RANGE_RE.search(snippet, after_pos)
+    range_match = RANGE_RE.search(line, after_pos)
     ref_min = ref_max = None
     if range_match:
         ref_min = _adjust_ref_value(range_match.group("min"))
@@ -178,7 +239,8 @@ def _extract_tsh_from_labelled_line(line: str) -> Optional[TSHMatch]:
         ref_max=ref_max,
         span=m.span(),
         raw_line=line,
-        raw_snippet=snippet,
+        label_penalty=_label_penalty(label),
+        snippet_start=snippet_start,
     )
 
 
@@ -186,6 +248,10 @@ def _extract_tsh_from_labelled_line(line: str) -> Optional[TSHMatch]:
 # Fallback : ligne avec mUI / UI/L même sans label (cas image 2)
 # --------------------------------------------------------------------
 
+_MUI_FALLBACK_LABEL = "TSH (fallback mUI)"
+_MUI_FALLBACK_PENALTY = _label_penalty(_MUI_FALLBACK_LABEL)
+
+
 def _extract_tsh_from_mui_line(line: str) -> Optional[TSHMatch]:
     """
     Fallback : pour les cas où le label TSH a sauté à l'OCR (ex: image 2 Cerballiance).
@@ -195,47 +261,44 @@ def _extract_tsh_from_mui_line(line: str) -> Optional[TSHMatch]:
       - on prend le nombre juste AVANT 'mUI' comme TSH
       - on essaie de récupérer une éventuelle plage x - y derrière
     """
-    if "mui" not in line.lower() and "ui/l" not in line.lower():
+    lowered = line.lower()
+    if "mui" not in lowered and "ui/l" not in lowered:
         return None
 
-    # On coupe autour de 'mUI' / 'UI/L'
-    unit_match = re.search(
-        r"(m ?UI/?L|µ ?UI/?L|u ?UI/?mL|mIU/?L|mU/?L|UI/?L|mUI|µUI|uUI)",
-        line,
-        re.IGNORECASE,
-    )
+    # On se repère autour de 'mUI' / 'UI/L'
+    unit_match = FALLBACK_UNIT_RE.search(line)
     if not unit_match:
         return None
 
     unit = unit_match.group(0)
-    before = line[:unit_match.start()]
-    after = line[unit_match.end():]
 
-    # TSH value = dernier nombre avant l'unité
-    nums_before = list(NUM_RE.finditer(before))
-    if not nums_before:
+    # TSH value = dernier nombre avant l'unité (on ne garde que le dernier
+    # match, sans construire la liste de tous les nombres de la ligne)
+    tsh_num = None
+    for tsh_num in NUM_RE.finditer(line, 0, unit_match.start()):
+        pass
+    if tsh_num is None:
         return None
-    tsh_num = nums_before[-1]
     tsh_value = _to_float(tsh_num.group())
     if tsh_value is None:
         return None
 
     # Plage éventuelle après l'unité
-    range_match = RANGE_RE.search(after)
+    range_match = RANGE_RE.search(line, unit_match.end())
     ref_min = ref_max = None
     if range_match:
         ref_min = _adjust_ref_value(range_match.group("min"))
         ref_max = _adjust_ref_value(range_match.group("max"))
 
     return TSHMatch(
-        label="TSH (fallback mUI)",
+        label=_MUI_FALLBACK_LABEL,
         value=tsh_value,
         unit=unit,
         ref_min=ref_min,
         ref_max=ref_max,
         span=(0, len(line)),
         raw_line=line,
-        raw_snippet=line,
+        label_penalty=_MUI_FALLBACK_PENALTY,
     )
 
 
@@ -245,20 +308,26 @@ def _extract_tsh_from_mui_line(line: str) -> Optional[TSHMatch]:
 
 def _find_tsh_candidates(raw_text: str) -> List[TSHMatch]:
     text = _normalize_text(raw_text)
-    lines = text.split("\n")
     candidates: List[TSHMatch] = []
 
-    # 1) Candidats avec label explicite TSH
-    for line in lines:
-        if not LABEL_RE.search(line) and "thyr" not in line.lower():
+    # 1) Candidats avec label explicite TSH : un seul passage de LABEL_RE
+    #    sur tout le texte, l'extraction ne tourne que sur les lignes touchées
+    last_line_start = -1
+    for m in LABEL_RE.finditer(text):
+        line_start = text.rfind("\n", 0, m.start()) + 1
+        if line_start == last_line_start:
             continue
-        cand = _extract_tsh_from_labelled_line(line)
+        last_line_start = line_start
+        line_end = text.find("\n", m.start())
+        if line_end == -1:
+            line_end = len(text)
+        cand = _extract_tsh_from_labelled_line(text[line_start:line_end])
         if cand:
             candidates.append(cand)
 
     # 2) Si aucun candidat avec label, on tente le fallback "mUI"
     if not candidates:
-        for line in lines:
+        for line in text.split("\n"):
             fallback_cand = _extract_tsh_from_mui_line(line)
             if fallback_cand:
                 candidates.append(fallback_cand)
@@ -278,27 +347,18 @@ def _score_candidate(c: TSHMatch) -> tuple:
       3. Permet de trier sans être trop violent.
     """
     has_range = 0 if (c.ref_min is not None and c.ref_max is not None) else 1
-
-    l = c.label.lower()
-    if "fallback" in l:
-        label_penalty = 2
-    elif "tsh" in l:
-        label_penalty = 0
-    elif "thyr" in l:
-        label_penalty = 1
-    else:
-        label_penalty = 3
-
-    return (has_range, label_penalty)
+    return (has_range, c.label_penalty)
 
 
 def _pick_best_candidate(candidates: List[TSHMatch]) -> Optional[TSHMatch]:
     if not candidates:
         return None
-    return sorted(
+    # min() : un seul passage, pas de liste triée intermédiaire ; renvoie
+    # le premier ex aequo, comme sorted(...)[0]
+    return min(
         candidates,
         key=lambda c: (*_score_candidate(c), c.span[0]),
-    )[0]
+    )
 
 
 # --------------------------------------------------------------------
@@ -313,16 +373,30 @@ def premium_parse_tsh(raw_text: str, boxes) -> ParsedTSH:
       - repère la ligne TSH (y compris T.S.H 3ème génération)
       - extrait : valeur, unité, bornes si possible
       - si aucun label TSH trouvé : fallback sur la ligne 'mUI/L'
+
+    `boxes` n'est pas exploité pour l'instant.
     """
-    text = raw_text or ""
+    return _parse_tsh_text(raw_text or "")
+
+
+# Résultat "pas de TSH" : ParsedTSH est immuable, une seule instance suffit
+_NOT_FOUND = ParsedTSH(ok=False, error="TSH_NOT_FOUND")
+
+
+# Un même texte OCR est souvent re-parsé (retry Bubble sur un bilan déjà en
+# cache OCR, mode auto) : le résultat est mémoïsé sur le texte lui-même
+# (hash de str mis en cache par Python, et la chaîne est déjà retenue par
+# le cache OCR)
+@lru_cache(maxsize=256)
+def _parse_tsh_text(text: str) -> ParsedTSH:
     candidates = _find_tsh_candidates(text)
 
     if not candidates:
-        return ParsedTSH(ok=False, error="TSH_NOT_FOUND")
+        return _NOT_FOUND
 
     best = _pick_best_candidate(candidates)
     if not best:
-        return ParsedTSH(ok=False, error="TSH_NOT_FOUND")
+        return _NOT_FOUND
 
     if best.ref_min is not None and best.ref_max is not None:
         confidence = "high"